@@ -1,9 +1,14 @@
 """DataSinks"""
+import os
 import re
-from pathlib import Path
+import gzip
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from json import dumps
-import numpy as np
-import nibabel as nb
+from math import isfinite
+from shutil import copyfileobj
+from types import MappingProxyType
 from nipype.interfaces.io import add_traits
 from nipype.interfaces.base import (
     BaseInterfaceInputSpec, DynamicTraitedSpec, SimpleInterface, TraitedSpec,
@@ -11,6 +16,11 @@ from nipype.interfaces.base import (
 )
 from niworkflows.utils.misc import splitext as _splitext, _copy_any
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 
 BIDS_NAME = re.compile(
     r'^(.*\/)?'
@@ -21,6 +31,184 @@ BIDS_NAME = re.compile(
     '(_(?P<rec_id>rec-[a-zA-Z0-9]+))?'
     '(_(?P<run_id>run-[a-zA-Z0-9]+))?')
 
+# Byte offsets of (qform_code, sform_code, xyzt_units) and their struct formats,
+# indexed by ``sizeof_hdr`` (NIfTI-1 and NIfTI-2)
+NIFTI_CODE_FIELDS = {
+    348: ((252, 'h'), (254, 'h'), (123, 'B')),
+    540: ((344, 'i'), (348, 'i'), (500, 'i')),
+}
+NIFTI_SPACE_UNITS = {1: 'meter', 2: 'mm', 3: 'micron'}
+NIFTI_TIME_UNITS = {8: 'sec', 16: 'msec', 24: 'usec', 32: 'hz', 40: 'ppm', 48: 'rads'}
+
+
+@lru_cache(maxsize=1024)
+def _parse_source(source_file):
+    """
+    Split ``source_file`` into its stem, data type suffix, BIDS entities and modality folder.
+
+    Memoized, as many sinks of a workflow typically share the same source file.
+    """
+    src_fname, _ = _splitext(source_file)
+    src_fname, dtype = src_fname.rsplit('_', 1)
+    m = BIDS_NAME.search(src_fname)
+    if m is None:
+        raise ValueError('Could not parse BIDS entities from "%s".' % source_file)
+    # Read-only, as the same mapping is handed to every caller
+    entities = MappingProxyType(m.groupdict())
+    mod = os.path.basename(os.path.dirname(os.path.normpath(source_file)))
+    return src_fname, dtype, entities, mod
+
+
+@lru_cache(maxsize=1)
+def _standard_spaces():
+    """Return the identifiers of all TemplateFlow templates (fetched once)."""
+    from templateflow.api import templates
+    return frozenset(templates())
+
+
+def _peek_nifti_codes(fname):
+    """
+    Read the qform/sform codes and the units straight from the header bytes of ``fname``.
+
+    Returns ``None`` if ``fname`` does not look like a NIfTI-1/NIfTI-2 file.
+    """
+    src_open = gzip.open if fname.endswith('.gz') else open
+    with src_open(fname, 'rb') as fh:
+        buf = fh.read(540)
+    if len(buf) < 348:
+        return None
+
+    for endian in '<>':
+        fields = NIFTI_CODE_FIELDS.get(struct.unpack(endian + 'i', buf[:4])[0])
+        if fields is not None and len(buf) >= max(f[0] for f in fields) + 4:
+            break
+    else:
+        return None
+
+    qcode, scode, units = [struct.unpack_from(endian + fmt, buf, offset)[0]
+                           for offset, fmt in fields]
+    return ((qcode, scode),
+            (NIFTI_SPACE_UNITS.get(units % 8), NIFTI_TIME_UNITS.get(units - units % 8)))
+
+
+def _fix_nifti_header(fname, header_class, affine, xcodes, units):
+    """
+    Set the qform/sform codes and the units of the NIfTI file ``fname``.
+
+    Only the header bytes are rewritten, the data array is never decoded:
+    uncompressed files are patched in place, while compressed files (and
+    files hard-linked to their source by ``_copy_any``) are streamed into
+    a new file.
+    """
+    is_gz = fname.endswith('.gz')
+    src_open = gzip.open if is_gz else open
+    size = header_class.template_dtype.itemsize
+    with src_open(fname, 'rb') as f_in:
+        # Parse the header as stored on disk (e.g., keep scaling factors)
+        hdr = header_class(f_in.read(size), check=False)
+    hdr.set_qform(affine, xcodes[0])
+    hdr.set_sform(affine, xcodes[1])
+    hdr.set_xyzt_units(*units)
+    block = hdr.binaryblock
+
+    if not is_gz and os.stat(fname).st_nlink == 1:
+        with open(fname, 'r+b') as f_out:
+            f_out.write(block)
+        return
+
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    try:
+        with src_open(fname, 'rb') as f_in, open(tmp_fname, 'wb') as f_out:
+            f_in.seek(size)
+            dst = f_out
+            if is_gz:
+                dst = gzip.GzipFile(filename='', mode='wb', compresslevel=1,
+                                    fileobj=f_out, mtime=0)
+            dst.write(block)
+            copyfileobj(f_in, dst, 1 << 20)
+            if is_gz:
+                dst.close()
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        if os.path.lexists(tmp_fname):
+            os.unlink(tmp_fname)
+        raise
+
+
+def _copy_and_fix(fname, out_file, xcodes=None, time_units=None):
+    """
+    Copy ``fname`` into ``out_file`` and, if ``xcodes`` are given, fix its NIfTI header.
+
+    Returns whether the file was (un)compressed and whether its header was fixed.
+    """
+    compression = _copy_any(fname, out_file)
+
+    is_nii = out_file.endswith('.nii') or out_file.endswith('.nii.gz')
+    if xcodes is None or not is_nii:
+        return compression, False
+
+    # Fast path: most derivatives already carry the right codes
+    peek = _peek_nifti_codes(out_file)
+    if peek is not None:
+        curr_codes, (space_units, curr_time_units) = peek
+        if curr_codes == xcodes and space_units is not None \
+                and curr_time_units == time_units:
+            return compression, False
+
+    import nibabel as nb
+    nii = nb.load(out_file)
+    if not isinstance(nii, (nb.Nifti1Image, nb.Nifti2Image)):
+        # .dtseries.nii are CIfTI2, therefore skip check
+        return compression, False
+    hdr = nii.header
+    curr_units = tuple([None if u == 'unknown' else u
+                        for u in hdr.get_xyzt_units()])
+    curr_codes = (int(hdr['qform_code']), int(hdr['sform_code']))
+
+    # Default to mm
+    units = (curr_units[0] or 'mm', time_units)
+    if curr_codes == xcodes and curr_units == units:
+        return compression, False
+
+    _fix_nifti_header(out_file, nii.header_class, nii.affine, xcodes, units)
+    return compression, True
+
+
+@lru_cache(maxsize=None)
+def _editable_traits(spec):
+    """Return the names of the editable traits of input spec class ``spec`` (computed once)."""
+    return frozenset(spec.class_editable_traits())
+
+
+def _has_nonfinite(obj):
+    """Check whether ``obj`` contains a NaN or infinite number."""
+    if isinstance(obj, dict):
+        return any(_has_nonfinite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_nonfinite(v) for v in obj)
+    return isinstance(obj, float) and not isfinite(obj)
+
+
+def _dumps(obj, pretty=True):
+    """Serialize ``obj`` as JSON bytes (with ``orjson`` if available).
+
+    Pretty output is sorted and indented, otherwise the most compact form is emitted.
+    """
+    if orjson is not None:
+        option = orjson.OPT_SORT_KEYS | orjson.OPT_INDENT_2 if pretty else 0
+        try:
+            data = orjson.dumps(obj, option=option)
+        except TypeError:
+            # e.g., numpy values or integers wider than 64 bits: let the
+            # standard library accept or reject them as it always did
+            data = None
+        # orjson silently writes NaN/Infinity as null
+        if data is not None and (b'null' not in data or not _has_nonfinite(obj)):
+            return data
+    if pretty:
+        return dumps(obj, sort_keys=True, indent=2).encode('utf-8')
+    return dumps(obj, separators=(',', ':')).encode('utf-8')
+
 
 class DerivativesDataSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
     base_directory = traits.Directory(
@@ -53,6 +241,7 @@ class DerivativesDataSink(SimpleInterface):
     Saves the `in_file` into a BIDS-Derivatives folder provided
     by `base_directory`, given the input reference `source_file`.
     >>> import tempfile
+    >>> from pathlib import Path
     >>> tmpdir = Path(tempfile.mkdtemp())
     >>> tmpfile = tmpdir / 'a_temp_file.nii.gz'
     >>> tmpfile.open('w').close()  # "touch" the file
@@ -151,14 +340,17 @@ desc-preproc_bold.json'
     input_spec = DerivativesDataSinkInputSpec
     output_spec = DerivativesDataSinkOutputSpec
     out_path_base = "templateflowreg"
+    pretty_json = True
+    durable = False
     _always_run = True
 
     def __init__(self, allowed_entities=None, out_path_base=None, **inputs):
         self._allowed_entities = allowed_entities or []
 
         self._metadata = {}
-        self._static_traits = self.input_spec.class_editable_traits() + self._allowed_entities
-        for dynamic_input in set(inputs) - set(self._static_traits):
+        self._static_traits = _editable_traits(self.input_spec).union(
+            self._allowed_entities)
+        for dynamic_input in set(inputs) - self._static_traits:
             self._metadata[dynamic_input] = inputs.pop(dynamic_input)
 
         super(DerivativesDataSink, self).__init__(**inputs)
@@ -172,38 +364,25 @@ desc-preproc_bold.json'
             self.out_path_base = out_path_base
 
     def _run_interface(self, runtime):
-        if isdefined(self.inputs.meta_dict):
-            meta = self.inputs.meta_dict
-            # inputs passed in construction take priority
-            meta.update(self._metadata)
-            self._metadata = meta
-
-        src_fname, _ = _splitext(self.inputs.source_file)
-        src_fname, dtype = src_fname.rsplit('_', 1)
+        src_fname, dtype, gd, mod = _parse_source(self.inputs.source_file)
         _, ext = _splitext(self.inputs.in_file[0])
         if self.inputs.compress is True and not ext.endswith('.gz'):
             ext += '.gz'
         elif self.inputs.compress is False and ext.endswith('.gz'):
             ext = ext[:-3]
 
-        m = BIDS_NAME.search(src_fname)
-
-        mod = Path(self.inputs.source_file).parent.name
-
         base_directory = runtime.cwd
         if isdefined(self.inputs.base_directory):
             base_directory = self.inputs.base_directory
 
-        base_directory = Path(base_directory).resolve()
-        out_path = base_directory / self.out_path_base / \
-            '{subject_id}'.format(**m.groupdict())
+        out_path = os.path.join(os.path.realpath(base_directory), self.out_path_base,
+                                gd['subject_id'])
+        if gd.get('session_id') is not None:
+            out_path = os.path.join(out_path, gd['session_id'])
+        out_path = os.path.join(out_path, mod)
 
-        if m.groupdict().get('session_id') is not None:
-            out_path = out_path / '{session_id}'.format(**m.groupdict())
-
-        out_path = out_path / '{}'.format(mod)
-        out_path.mkdir(exist_ok=True, parents=True)
-        base_fname = str(out_path / src_fname)
+        os.makedirs(out_path, exist_ok=True)
+        base_fname = os.path.join(out_path, src_fname)
 
         allowed_entities = {}
         for key in self._allowed_entities:
@@ -211,76 +390,74 @@ desc-preproc_bold.json'
             if value is not None and isdefined(value):
                 allowed_entities[key] = '_%s-%s' % (key, value)
 
-        formatbase = '{bname}{space}{desc}' + ''.join(
-            [allowed_entities.get(s, '') for s in self._allowed_entities])
-
-        formatstr = formatbase + '{extra}{suffix}{dtype}{ext}'
-        if len(self.inputs.in_file) > 1 and not isdefined(self.inputs.extra_values):
-            formatstr = formatbase + '{suffix}{i:04d}{dtype}{ext}'
-
         space = '_space-{}'.format(self.inputs.space) if self.inputs.space else ''
         desc = '_desc-{}'.format(self.inputs.desc) if self.inputs.desc else ''
         suffix = '_{}'.format(self.inputs.suffix) if self.inputs.suffix else ''
         dtype = '' if not self.inputs.keep_dtype else ('_%s' % dtype)
 
-        self._results['compression'] = []
-        self._results['fixed_hdr'] = [False] * len(self.inputs.in_file)
-
-        for i, fname in enumerate(self.inputs.in_file):
-            extra = ''
-            if isdefined(self.inputs.extra_values):
-                extra = '_{}'.format(self.inputs.extra_values[i])
-            out_file = formatstr.format(
-                bname=base_fname,
-                space=space,
-                desc=desc,
-                extra=extra,
-                suffix=suffix,
-                i=i,
-                dtype=dtype,
-                ext=ext,
-            )
-            self._results['out_file'].append(out_file)
-            self._results['compression'].append(_copy_any(fname, out_file))
-
-            is_nii = out_file.endswith('.nii') or out_file.endswith('.nii.gz')
-            if self.inputs.check_hdr and is_nii:
-                nii = nb.load(out_file)
-                if not isinstance(nii, (nb.Nifti1Image, nb.Nifti2Image)):
-                    # .dtseries.nii are CIfTI2, therefore skip check
-                    return runtime
-                hdr = nii.header.copy()
-                curr_units = tuple([None if u == 'unknown' else u
-                                    for u in hdr.get_xyzt_units()])
-                curr_codes = (int(hdr['qform_code']), int(hdr['sform_code']))
-
-                # Default to mm, use sec if data type is bold
-                units = (curr_units[0] or 'mm', 'sec' if dtype == '_bold' else None)
-                xcodes = (1, 1)  # Derivative in its original scanner space
-                if self.inputs.space:
-                    from templateflow.api import templates as _get_template_list
-                    STANDARD_SPACES = _get_template_list()
-                    xcodes = (4, 4) if self.inputs.space in STANDARD_SPACES \
-                        else (2, 2)
-
-                if curr_codes != xcodes or curr_units != units:
-                    self._results['fixed_hdr'][i] = True
-                    hdr.set_qform(nii.affine, xcodes[0])
-                    hdr.set_sform(nii.affine, xcodes[1])
-                    hdr.set_xyzt_units(*units)
-
-                    # Rewrite file with new header
-                    nii.__class__(np.array(nii.dataobj), nii.affine, hdr).to_filename(
-                        out_file)
-
-        if len(self._results['out_file']) == 1:
-            meta_fields = self.inputs.copyable_trait_names()
-            self._metadata.update({
-                k: getattr(self.inputs, k)
-                for k in meta_fields if k not in self._static_traits})
-            if self._metadata:
-                sidecar = (Path(self._results['out_file'][0]).parent /
-                           ('%s.json' % _splitext(self._results['out_file'][0])[0]))
-                sidecar.write_text(dumps(self._metadata, sort_keys=True, indent=2))
-                self._results['out_meta'] = str(sidecar)
+        xcodes = time_units = None
+        # All outputs share ``ext``: only NIfTI outputs need the header targets
+        if self.inputs.check_hdr and ext.endswith(('.nii', '.nii.gz')):
+            # Use sec if data type is bold
+            time_units = 'sec' if dtype == '_bold' else None
+            xcodes = (1, 1)  # Derivative in its original scanner space
+            if self.inputs.space:
+                xcodes = (4, 4) if self.inputs.space in _standard_spaces() \
+                    else (2, 2)
+
+        # Only the extra/index part of the name varies across inputs
+        prefix = base_fname + space + desc + ''.join(
+            [allowed_entities.get(s, '') for s in self._allowed_entities])
+        tail = dtype + ext
+
+        nfiles = len(self.inputs.in_file)
+        if isdefined(self.inputs.extra_values):
+            extra_values = self.inputs.extra_values
+            out_files = ['{}_{}{}{}'.format(prefix, extra_values[i], suffix, tail)
+                         for i in range(nfiles)]
+        elif nfiles > 1:
+            out_files = ['%s%s%04d%s' % (prefix, suffix, i, tail) for i in range(nfiles)]
+        else:
+            out_files = [prefix + suffix + tail]
+        self._results['out_file'] = out_files
+        self._results['compression'] = [None] * nfiles
+        self._results['fixed_hdr'] = [False] * nfiles
+
+        def _process(i):
+            # Each task writes its own index, so no locking is needed
+            self._results['compression'][i], self._results['fixed_hdr'][i] = \
+                _copy_and_fix(self.inputs.in_file[i], out_files[i], xcodes, time_units)
+
+        if nfiles == 1:
+            _process(0)
+        else:
+            # Copies and header fixes are I/O bound and release the GIL
+            with ThreadPoolExecutor(max_workers=min(8, nfiles)) as executor:
+                list(executor.map(_process, range(nfiles)))
+
+        # Sidecars are only written for single-file sinks
+        if nfiles != 1:
+            return runtime
+
+        if isdefined(self.inputs.meta_dict):
+            meta = self.inputs.meta_dict
+            # inputs passed in construction take priority
+            meta.update(self._metadata)
+            self._metadata = meta
+
+        meta_fields = self.inputs.copyable_trait_names()
+        self._metadata.update({
+            k: getattr(self.inputs, k)
+            for k in meta_fields if k not in self._static_traits})
+        if not self._metadata:
+            return runtime
+
+        sidecar = os.path.join(os.path.dirname(out_files[0]),
+                               '%s.json' % _splitext(out_files[0])[0])
+        with open(sidecar, 'wb', buffering=1 << 16) as fh:
+            fh.write(_dumps(self._metadata, pretty=self.pretty_json))
+            fh.flush()
+            if self.durable:
+                os.fsync(fh.fileno())
+        self._results['out_meta'] = sidecar
         return runtime